@@ -1,22 +1,27 @@
 # pylint: disable=invalid-name,no-name-in-module,import-error
-import json
+import asyncio
+import hmac
+import http.client
 import logging  # for setting requests log level
+import queue
 import random
 import socket
+import struct
 import sys
+import threading
 from functools import partial
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from http.cookies import SimpleCookie, CookieError
-from socketserver import ThreadingMixIn
-from urllib.parse import urlparse, parse_qs
+from itertools import groupby
 
 import click
+import orjson
 import requests
+from aiohttp import web
+from requests.adapters import HTTPAdapter
 from loguru import logger
 
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QMessageBox, QAction, QFileDialog
-from PyQt5.QtGui import QPainter, QPen, QImage, QColor, QCursor, QPixmap, QPolygon
-from PyQt5.QtCore import Qt, QPoint
+from PyQt5.QtGui import QPainter, QPainterPath, QPen, QImage, QColor, QCursor, QPixmap, QPolygon
+from PyQt5.QtCore import Qt, QPoint, QRect, QTimer, QThread, QBuffer, QIODevice, pyqtSignal
 
 
 # available colors
@@ -29,26 +34,218 @@ COLORS = [
     ("white", QColor(255, 255, 255)),
 ]
 COLOR_NAMES = [cname for cname, _qcolor in COLORS]
+COLOR_INDEX = {qcolor.rgb(): i for i, (_cname, qcolor) in enumerate(COLORS)}
+
+# client HTTP settings
+LONG_POLL_WAIT = 5  # s the server may hold an /updates request while nothing happens
+POLL_TIMEOUT = (1, LONG_POLL_WAIT + 5)  # (connect, read) in seconds
+RETRY_MAX_BACKOFF = 5000  # ms, poll retries back off exponentially up to that
+SNAPSHOT_RETRIES = 3  # failed /snapshots before replaying the history instead
+SEND_TIMEOUT = (1, 2)  # (connect, read) in seconds, sending runs in the GUI thread
+
+# server side settings
+LONG_POLL_MAX = 25  # s, limit for long-polling
+KEEP_ALIVE_TIMEOUT = 60  # s, idle keep-alive connections are closed after that
+SNAPSHOT_MAX_SIZE = 4096  # px, max. width and height of rendered snapshots
+MAX_LAG = 2000  # paint events; clients further behind are told to fetch a snapshot
+
+# client side batching of paint events
+BATCH_INTERVAL = 30  # ms between flushes to the server
+BATCH_MAX = 500  # flush early if that many paint events are pending
 
 
 
 # server conventions
+# colors are 24 bit RGB, points are two 16 bit coordinates packed into 32 bit,
+# both hex encoded. Older exports use "r,g,b" and "x,y", which we still decode.
 
 def encode_color(qcolor):
-    r, g, b, _alpha = qcolor.getRgb()
-    return f"{r},{g},{b}"
+    return f"{qcolor.rgb() & 0xFFFFFF:06x}"
 
 def decode_color(color_str):
-    r, g, b = color_str.split(",")
-    return QColor(int(r), int(g), int(b))
+    if "," in color_str:
+        r, g, b = color_str.split(",")
+        return QColor(int(r), int(g), int(b))
+    return QColor(int(color_str, 16) | 0xFF000000)
+
+def encode_xy(x, y):
+    # dragging beyond the widget gives negative coordinates, hence the masking
+    return f"{(x & 0xFFFF) << 16 | y & 0xFFFF:x}"
 
-def encode_point(qpoint):
-    x, y = qpoint.x(), qpoint.y()
-    return f"{x},{y}"
+def _signed16(v):
+    return v - 0x10000 if v & 0x8000 else v
 
 def decode_point(point_str):
-    x, y = point_str.split(",")
-    return QPoint(int(x), int(y))
+    if "," in point_str:
+        x, y = point_str.split(",")
+        return QPoint(int(x), int(y))
+    v = int(point_str, 16)
+    return QPoint(_signed16(v >> 16), _signed16(v & 0xFFFF))
+
+# binary paint events, as sent by the client to POST /d:
+# color index into COLORS, start x/y, end x/y, width
+PAINT_RECORD = struct.Struct(">BhhhhB")
+COLOR_CODES = [encode_color(qcolor) for _cname, qcolor in COLORS]
+
+def pack_paintcode(*, start_point, end_point, color, width):
+    return PAINT_RECORD.pack(
+        COLOR_INDEX[color.rgb()],
+        start_point.x(), start_point.y(),
+        end_point.x(), end_point.y(),
+        width,
+    )
+
+def unpack_paintcodes(buf):
+    """ Binary paint events to the usual paint code dicts.
+    """
+    return [
+        {
+            "color": COLOR_CODES[color_index],
+            "width": width,
+            "start_point": encode_xy(sx, sy),
+            "end_point": encode_xy(ex, ey),
+        }
+        for color_index, sx, sy, ex, ey, width in PAINT_RECORD.iter_unpack(buf)
+    ]
+
+def check_paint_code(pc):
+    """ Paint code dict as we store it; raises ValueError, TypeError or
+        KeyError if it's not something clients can decode.
+    """
+    event = {
+        "color": pc["color"],
+        "width": int(pc["width"]),
+        "start_point": pc["start_point"],
+        "end_point": pc["end_point"],
+    }
+    if not all(isinstance(event[key], str) for key in ("color", "start_point", "end_point")):
+        raise TypeError(f"color and points must be strings: {pc}")
+    if not 0 < event["width"] < 256:
+        raise ValueError(f"invalid width: {event['width']}")
+    if any(len(event[key]) > 16 for key in ("color", "start_point", "end_point")):
+        raise ValueError(f"color or point too long: {pc}")
+    try:
+        decode_color(event["color"])
+        decode_point(event["start_point"])
+        decode_point(event["end_point"])
+    except OverflowError as err:  # out of range for QColor/QPoint
+        raise ValueError(str(err)) from err
+    return event
+
+def parse_query(query):
+    """ Minimal query string parser for our own fixed, unquoted parameters;
+        much cheaper than `parse_qs`.
+    """
+    return dict(param.partition("=")[::2] for param in query.split("&") if param)
+
+def make_session(passphrase):
+    session = requests.Session()
+    # one server, tiny JSON payloads: small pool, no gzip, no UA
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4, pool_block=False))
+    session.headers.clear()
+    session.headers["Connection"] = "keep-alive"
+    session.cookies.set("passphrase", passphrase)
+    return session
+
+
+def line_rect(start_point, end_point, width):
+    """ Rect covered by a line drawn with a round pen of `width`.
+    """
+    margin = width // 2 + 1
+    return QRect(start_point, end_point).normalized().adjusted(-margin, -margin, margin, margin)
+
+def make_pen(color, width):
+    return QPen(color, width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+
+
+class PenCache(dict):
+    """ Callable drop-in for `make_pen` that creates each QPen only once.
+    """
+    def __call__(self, color, width):
+        key = (color.rgb(), width)
+        pen = self.get(key)
+        if pen is None:
+            pen = self[key] = make_pen(color, width)
+        return pen
+
+
+def paint_lines(image, lines, pen=make_pen):
+    """ Draw (start_point, end_point, color, width) lines onto `image` with
+        a single painter; `pen(color, width)` supplies the QPens.
+        Consecutive lines of the same color and width are drawn as one
+        QPainterPath. Only consecutive ones though, so the order in which
+        strokes overlap stays the same.
+        Returns the bounding rect of all lines.
+    """
+    dirty = QRect()
+    painter = QPainter(image)
+    for _key, group in groupby(lines, key=lambda line: (line[2].rgb(), line[3])):
+        path = QPainterPath()
+        last_point = None
+        for start_point, end_point, color, width in group:
+            if start_point != last_point:
+                path.moveTo(start_point.x(), start_point.y())
+            path.lineTo(end_point.x(), end_point.y())
+            last_point = end_point
+            dirty |= line_rect(start_point, end_point, width)
+        painter.setPen(pen(color, width))  # pylint: disable=undefined-loop-variable
+        painter.drawPath(path)
+    painter.end()
+    return dirty
+
+def decode_paint_codes(paint_codes):
+    for pc in paint_codes:
+        yield (
+            decode_point(pc["start_point"]),
+            decode_point(pc["end_point"]),
+            decode_color(pc["color"]),
+            pc["width"],
+        )
+
+def render_png(paint_codes):
+    """ Render paint events into a PNG just big enough to hold them.
+    """
+    lines = list(decode_paint_codes(paint_codes))
+    bounds = QRect()
+    for start_point, end_point, _color, width in lines:
+        bounds |= line_rect(start_point, end_point, width)
+    image = QImage(
+        max(1, min(bounds.right() + 1, SNAPSHOT_MAX_SIZE)),
+        max(1, min(bounds.bottom() + 1, SNAPSHOT_MAX_SIZE)),
+        QImage.Format_RGB32,
+    )
+    image.fill(Qt.white)
+    paint_lines(image, lines, PenCache())
+    buf = QBuffer()
+    buf.open(QIODevice.WriteOnly)
+    image.save(buf, "PNG")
+    return bytes(buf.data())
+
+
+# (rgb, width) -> QCursor; filled on first use, as QPixmaps need a QApplication
+CURSOR_CACHE = {}
+
+def make_pen_cursor(color, width):
+    pixmap = QPixmap(32, 32)
+    pixmap.fill(Qt.transparent)
+    painter = QPainter(pixmap)
+    painter.setPen(Qt.black)
+    painter.setBrush(color)
+    painter.drawRect(10, 15, 8, 30)  # Rectangle for the pen body
+    painter.setBrush(color)
+    painter.drawPolygon(
+        QPolygon([
+            QPoint(10, 15),  # Top-left corner of the pen body
+            QPoint(18, 15),  # Top-right corner of the pen body
+            QPoint(14, 5)    # Tip of the pen
+        ])
+    )
+    painter.setPen(
+        QPen(Qt.black, width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+    )
+    painter.drawPoint(14, 5)
+    painter.end()
+    return QCursor(pixmap, 14, 5)  # Hot spot at the tip of the pen
 
 
 class Canvas(QWidget):
@@ -64,22 +261,25 @@ class Canvas(QWidget):
         self.setAttribute(Qt.WA_StaticContents)
         self.drawing = False
         self.last_point = QPoint()
+        self.pen = PenCache()
         self.image = QImage(self.size(), QImage.Format_RGB32)
         self.image.fill(Qt.white)
         self.set_pen_cursor()
 
-    def paintEvent(self, event):  # pylint: disable=unused-argument
+    def paintEvent(self, event):
+        # only copy the dirty part, image and widget have the same size
         painter = QPainter(self)
-        painter.drawImage(self.rect(), self.image, self.image.rect())
+        painter.drawImage(event.rect(), self.image, event.rect())
 
     def wheelEvent(self,event):
         steps = event.angleDelta().y() // 120
-        current_color = 0
-        for current_color, (_, qcolor) in enumerate(COLORS):
-            if qcolor == self.color:
-                break
+        current_color = COLOR_INDEX.get(self.color.rgb(), 0)
         new_color = (current_color + steps) % len(COLORS)
-        logger.debug(f"switch color from {COLORS[current_color][0]} to {COLORS[new_color][0]}")
+        logger.opt(lazy=True).debug(
+            "switch color from {} to {}",
+            lambda: COLORS[current_color][0],
+            lambda: COLORS[new_color][0],
+        )
         self.color = COLORS[new_color][1]
         self.set_pen_cursor()
 
@@ -96,7 +296,7 @@ class Canvas(QWidget):
                 color=self.color,
                 width=self.width,
             )
-            self.update()
+            self.update(line_rect(self.last_point, event.pos(), self.width))
             self.app.send_paintcode(
                 start_point=self.last_point,
                 end_point=event.pos(),
@@ -116,36 +316,39 @@ class Canvas(QWidget):
         painter.drawImage(0, 0, self.image)
         self.image = new_image
         super().resizeEvent(event)
-        self.app.update_from_beginning = True  # next timer redraws all
+        self.app.request_full_update()  # next poll redraws all
 
     def draw_line(self, *, start_point, end_point, color, width):
-        logger.debug(f"draw line {start_point.x()},{start_point.y()} to {end_point.x()},{end_point.y()} in #{hex(color.rgb())[4:]} {width}pt.")
+        # hot path: only format the message if debug output is on
+        logger.opt(lazy=True).debug(
+            "draw line {},{} to {},{} in #{} {}pt.",
+            start_point.x, start_point.y, end_point.x, end_point.y,
+            lambda: hex(color.rgb())[4:], lambda: width,
+        )
         painter = QPainter(self.image)
-        pen = QPen(color, width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-        painter.setPen(pen)
+        painter.setPen(self.pen(color, width))
         painter.drawLine(start_point, end_point)
+        painter.end()
 
-    def set_pen_cursor(self):
-        pixmap = QPixmap(32, 32)
-        pixmap.fill(Qt.transparent)
-        painter = QPainter(pixmap)
-        painter.setPen(Qt.black)
-        painter.setBrush(self.color)
-        painter.drawRect(10, 15, 8, 30)  # Rectangle for the pen body
-        painter.setBrush(self.color)
-        painter.drawPolygon(
-            QPolygon([
-                QPoint(10, 15),  # Top-left corner of the pen body
-                QPoint(18, 15),  # Top-right corner of the pen body
-                QPoint(14, 5)    # Tip of the pen
-            ])
-        )
-        painter.setPen(
-            QPen(Qt.black, self.width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-        )
-        painter.drawPoint(14, 5)
+    def draw_lines(self, lines):
+        """ Draw many (start_point, end_point, color, width) lines with a
+            single painter. Returns the bounding rect of all of them.
+        """
+        return paint_lines(self.image, lines, self.pen)
+
+    def draw_image(self, image):
+        """ Replace the painting with `image` (top left aligned).
+        """
+        self.image.fill(Qt.white)
+        painter = QPainter(self.image)
+        painter.drawImage(0, 0, image)
         painter.end()
-        cursor = QCursor(pixmap, 14, 5)  # Hot spot at the tip of the pen
+
+    def set_pen_cursor(self):
+        key = (self.color.rgb(), self.width)
+        cursor = CURSOR_CACHE.get(key)
+        if cursor is None:
+            cursor = CURSOR_CACHE[key] = make_pen_cursor(self.color, self.width)
         self.setCursor(cursor)
 
 
@@ -159,17 +362,28 @@ class DrawingApp(QMainWindow):
     def __init__(self, *, server, port, passphrase, update_interval, color):
         super().__init__()
         self.passphrase = passphrase
-        self.update_from_beginning = False
+        self._pending = []
+        self.poll_worker = None
         self.setWindowTitle("Distributed Paint")
         self.setGeometry(100, 100, 800, 600)
         self.filename = None
         self.canvas = Canvas(self, color)
         self.setCentralWidget(self.canvas)
         if server and port:
-            self.session = requests.Session()
-            self.session.cookies.set("passphrase", self.passphrase)
+            self.session = make_session(self.passphrase)
             self.base_url = f"http://{server}:{port}"
-            self.startTimer(update_interval)
+            self.poll_worker = PollWorker(
+                server=server,
+                port=port,
+                passphrase=self.passphrase,
+                interval=update_interval,
+            )
+            self.poll_worker.updates_ready.connect(self._apply_updates)
+            self.poll_worker.snapshot_ready.connect(self._apply_snapshot)
+            self.poll_worker.start()
+            self.flush_timer = QTimer(self)
+            self.flush_timer.timeout.connect(self.flush_paintcodes)
+            self.flush_timer.start(BATCH_INTERVAL)
         else:
             self.session = None
             self.base_url = None
@@ -219,9 +433,18 @@ class DrawingApp(QMainWindow):
         about_action.triggered.connect(self.show_about_dialog)
         help_menu.addAction(about_action)
 
-    def timerEvent(self, _event):
-        self.process_updates(from_beginning=self.update_from_beginning)
-        self.update_from_beginning = False
+    def closeEvent(self, event):
+        if self.session:
+            self.flush_paintcodes()
+        if self.poll_worker:
+            self.poll_worker.stop()
+        super().closeEvent(event)
+
+    def request_full_update(self):
+        """ Have the next poll fetch the whole painting, not just the news.
+        """
+        if self.poll_worker:
+            self.poll_worker.request_full_update()
 
     def set_color(self, qcolor):
         self.canvas.color = qcolor
@@ -258,10 +481,10 @@ class DrawingApp(QMainWindow):
         if file_path == "":
             return
         resp = self.session.get(f"{self.base_url}/updates?from_beginning=1")
-        with open(file_path, "w") as out:
-            for pc in resp.json():
-                out.write(json.dumps(pc, sort_keys=True) + "\n")
-        self.process_updates(from_beginning=True)
+        with open(file_path, "wb") as out:
+            for pc in orjson.loads(resp.content):
+                out.write(orjson.dumps(pc, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE))
+        self.request_full_update()
 
     def import_(self):
         file_path, _ = QFileDialog.getOpenFileName(
@@ -272,20 +495,32 @@ class DrawingApp(QMainWindow):
         )
         if file_path == "":
             return
-        with open(file_path) as inp:
-            self.clear()
-            for line in inp:
-                pc = json.loads(line)
-                self.session.get(
-                    f"{self.base_url}/draw?color={pc['color']}&width={pc['width']}&start_point={pc['start_point']}&end_point={pc['end_point']}",
+        try:
+            with open(file_path) as inp:
+                paint_codes = [orjson.loads(line) for line in inp if line.strip()]
+        except (OSError, ValueError) as err:
+            QMessageBox.warning(self, "Import", f"Can't read {file_path}:\n{err}")
+            return
+        self.clear()
+        # in chunks, the server limits request sizes
+        try:
+            for i in range(0, len(paint_codes), BATCH_MAX):
+                resp = self.session.post(
+                    f"{self.base_url}/draw_batch",
+                    data=orjson.dumps(paint_codes[i:i + BATCH_MAX]),
+                    headers={"Content-Type": "application/json"},
+                    timeout=SEND_TIMEOUT,
                 )
+                resp.raise_for_status()
+        except requests.RequestException as err:
+            QMessageBox.warning(self, "Import", f"Importing {file_path} failed:\n{err}")
 
     def clear(self):
         logger.debug("clearing whiteboard")
         self.session.get(f"{self.base_url}/new")
         self.canvas = Canvas(self, self.canvas.color)  # re-use old color
         self.setCentralWidget(self.canvas)
-        self.update_from_beginning = True
+        self.request_full_update()
         self.filename = None
         self.setWindowTitle("Distributed Paint")
         self.save_action.setDisabled(True)
@@ -298,149 +533,354 @@ class DrawingApp(QMainWindow):
         )
 
     def send_paintcode(self, *, start_point, end_point, color, width):
+        """ Queue a paint event; the flush timer sends them in batches.
+        """
         if self.session and start_point != end_point:
-            start_point = encode_point(start_point)
-            end_point = encode_point(end_point)
-            color = encode_color(color)
-            self.session.get(f"{self.base_url}/draw?color={color}&width={width}&start_point={start_point}&end_point={end_point}")
+            self._pending.append(pack_paintcode(
+                start_point=start_point,
+                end_point=end_point,
+                color=color,
+                width=width,
+            ))
+            if len(self._pending) >= BATCH_MAX:
+                self.flush_paintcodes()
 
-    def process_updates(self, from_beginning=False):
-        if self.session:
-            resp = self.session.get(f"{self.base_url}/updates{'?from_beginning=1' if from_beginning else ''}")
-            paint_codes = resp.json()
-            if not paint_codes:
-                return
-            logger.info(f"have to paint {len(paint_codes)} events")
-            for pc in paint_codes:
-                self.canvas.draw_line(
-                    start_point=decode_point(pc["start_point"]),
-                    end_point=decode_point(pc["end_point"]),
-                    color=decode_color(pc["color"]),
-                    width=pc["width"],
+    def flush_paintcodes(self):
+        if self._pending:
+            try:
+                self.session.post(
+                    f"{self.base_url}/d",
+                    data=b"".join(self._pending),
+                    headers={"Content-Type": "application/octet-stream"},
+                    timeout=SEND_TIMEOUT,
                 )
-            self.canvas.update()
-            logger.info(f"painted {len(paint_codes)} events")
+            except requests.RequestException as err:
+                # they're drawn locally; retrying would block every flush
+                logger.warning(f"sending {len(self._pending)} paint events failed: {err}")
+            self._pending.clear()
+
+    def _apply_updates(self, paint_codes):
+        """ Slot for `PollWorker.updates_ready`, runs in the GUI thread.
+        """
+        logger.info(f"have to paint {len(paint_codes)} events")
+        dirty = self.canvas.draw_lines(decode_paint_codes(paint_codes))
+        self.canvas.update(dirty)
+        logger.info(f"painted {len(paint_codes)} events")
 
+    def _apply_snapshot(self, png):
+        """ Slot for `PollWorker.snapshot_ready`, runs in the GUI thread.
+        """
+        logger.info(f"have to paint snapshot of {len(png)} bytes")
+        self.canvas.draw_image(QImage.fromData(png, "PNG"))
+        self.canvas.update()
 
-class PaintRequestHandler(BaseHTTPRequestHandler):
-    """ Dispatcher for the Paint Server.
+
+class HTTPStatusError(http.client.HTTPException):
+    """ Non-200 response; the connection itself is fine.
     """
-    def __init__(self, request, client_address, server):
-        self.protocol_version = "HTTP/1.1"  # needed for keep-alive
-        super().__init__(request, client_address, server)
 
-    def log_request(self, code="-", size="-"):
-        logger.info(f"{self.client_address[0]}:{self.client_address[1]} \"{self.requestline}\" {code} {size}")
 
-    def respond(self, http_status, content):
+class PollWorker(QThread):
+    """ Polls the server for updates in a background thread, so a slow
+        network never blocks the GUI. New paint events are handed to the
+        GUI thread via the `updates_ready` signal.
+        Polls are long-polls: the server holds the request until there
+        are new paint events (or LONG_POLL_WAIT is over).
+        Full redraws fetch a server rendered PNG (`snapshot_ready`) instead
+        of replaying the whole history.
+        The worker talks plain http.client over its own connection, so
+        `stop()` can shut down the socket of a pending long-poll.
+    """
+    updates_ready = pyqtSignal(list)
+    snapshot_ready = pyqtSignal(bytes)
+
+    def __init__(self, *, server, port, passphrase, interval):
+        super().__init__()
+        self.connection = http.client.HTTPConnection(server, port, timeout=POLL_TIMEOUT[0])
+        self.headers = {"Cookie": f"passphrase={passphrase}"}
+        self.interval = interval
+        self._from_beginning = False  # set from the GUI thread, hence the lock
+        self._from_beginning_lock = threading.Lock()
+        self._stop = False
+        self._wakeup = threading.Event()  # cuts sleeps short on stop()
+
+    def run(self):
+        failures = 0  # consecutive failed requests, for the backoff
+        snapshot_failures = 0
+        while not self._stop:
+            from_beginning = self._take_full_update()
+            try:
+                if from_beginning and snapshot_failures < SNAPSHOT_RETRIES:
+                    self.snapshot_ready.emit(self.get("/snapshot"))
+                    failures = snapshot_failures = 0
+                    continue
+                if from_beginning:
+                    # snapshots keep failing, replay the whole history instead
+                    paint_codes = orjson.loads(self.get("/updates?from_beginning=1"))
+                    snapshot_failures = 0
+                else:
+                    paint_codes = orjson.loads(self.get(f"/updates?wait={LONG_POLL_WAIT}"))
+                failures = 0
+            except (OSError, http.client.HTTPException, ValueError) as err:
+                if not isinstance(err, (HTTPStatusError, ValueError)):
+                    # broken connection, reconnect on the next request. Not
+                    # otherwise: the server knows clients by their connection
+                    self.connection.close()
+                if self._stop:
+                    break
+                logger.warning(f"polling for updates failed: {err}")
+                if from_beginning:
+                    snapshot_failures += 1
+                    self.request_full_update()  # try again next time
+                failures += 1
+                self.sleep(min(self.interval * 2 ** failures, RETRY_MAX_BACKOFF))
+            else:
+                if isinstance(paint_codes, dict) and paint_codes.get("reset"):
+                    self.request_full_update()  # too far behind, get a snapshot
+                elif isinstance(paint_codes, list) and paint_codes:
+                    self.updates_ready.emit(paint_codes)
+                    self.sleep(self.interval)  # let some more events pile up
+
+    def request_full_update(self):
+        with self._from_beginning_lock:
+            self._from_beginning = True
+
+    def _take_full_update(self):
+        with self._from_beginning_lock:
+            from_beginning, self._from_beginning = self._from_beginning, False
+        return from_beginning
+
+    def sleep(self, msecs):
+        self._wakeup.wait(msecs / 1000)
+
+    def get(self, path):
+        """ GET `path`, returns the body; raises OSError/HTTPException,
+            HTTPStatusError for non-200 responses.
+        """
+        if self.connection.sock is None:
+            self.connection.connect()  # with the connect timeout
+            self.connection.sock.settimeout(POLL_TIMEOUT[1])
+            if self._stop:  # stop() came while connecting
+                raise OSError("poll worker stopped")
+        self.connection.request("GET", path, headers=self.headers)
+        resp = self.connection.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+            raise HTTPStatusError(f"{resp.status} {resp.reason} for {path}")
+        return body
+
+    def stop(self):
+        """ Stop polling. Shuts down the socket of a pending long-poll, so
+            this doesn't wait up to LONG_POLL_WAIT for the server to answer.
+        """
+        self._stop = True
+        self._wakeup.set()
+        sock = self.connection.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # not connected (anymore)
+        self.wait()
+
+
+def client_of(request):
+    """ (host, port) of the request's connection, our notion of a client.
+    """
+    peername = request.transport.get_extra_info("peername") if request.transport else None
+    return tuple(peername[:2]) if peername else ("?", 0)
+
+def respond(http_status, content, content_type="application/json"):
+    if isinstance(content, str):
         content = content.encode()
-        self.send_response(http_status)
-        # if we want keep-alive we need content length
-        self.send_header("Connection", "Keep-Alive")
-        self.send_header("Content-Length", f"{len(content)}")
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(content)
-
-    def do_GET(self):
-        url = urlparse(self.path)
-        query = parse_qs(url.query, keep_blank_values=True)
-        try:
-            cookies = SimpleCookie(self.headers.get("Cookie"))
-            cookies["passphrase"].value  # pylint: disable=pointless-statement
-        except CookieError:
-            self.respond(
-                401,
-                json.dumps({"error": "bad cookie, what is wrong with you!"}),
-            )
-            return
-        if cookies["passphrase"].value != self.server.passphrase:
-            logger.error(f"wrong passphrase in cookies: {cookies['passphrase'].value}")
-            self.respond(
-                401,
-                json.dumps({"error": "not authorized"}),
-            )
-        elif url.path == "/status":
-            self.respond(
-                200,
-                self.server.status(),
-            )
-        elif url.path == "/new":
-            self.respond(
-                200,
-                self.server.new(client=self.client_address),
-            )
-        elif url.path == "/draw":
-            self.respond(
-                200,
-                self.server.draw(
-                    color=query["color"][0],
-                    width=query["width"][0],
-                    start_point=query["start_point"][0],
-                    end_point=query["end_point"][0],
-                    client=self.client_address,
-                ),
-            )
-        elif url.path == "/updates":
-            self.respond(
-                200,
-                self.server.get_updates(
-                    client=self.client_address,
-                    from_beginning="from_beginning" in query,
-                ),
-            )
-        else:
-            logger.warning(f"invalid request: {self.path} ({url})")
-            self.respond(400, f"unknown path: {url.path}")
+    return web.Response(status=http_status, body=content, content_type=content_type)
 
+def bad_request(request, err):
+    logger.warning(f"invalid request: {request.method} {request.path_qs} ({err!r})")
+    return respond(400, orjson.dumps({"error": f"invalid request: {err!r}"}))
 
-# need debian package wbritish-large
-try:
-    WORDLIST = [
-        word.strip()
-        for word in open("/usr/share/dict/british-english-large")
-        if "'" not in word and word[0].islower() and word.isascii()
-    ]
-except FileNotFoundError:
-    # just a selection of 99 random words
-    WORDLIST = [
-        "abstractions", "allspice", "anisometropias", "associative", "banderilla",
-        "brainteasers", "breaststrokes", "broadbills", "brooders", "cageling",
-        "captives", "carven", "cellulosic", "chapels", "cheerless", "chemosmosis",
-        "classmates", "clock", "corollary", "corrupting", "cucurbits", "culpably",
-        "deciles", "declaratory", "deerhounds", "digression", "diminishes",
-        "ectomere", "educe", "elegance", "eloign", "encompassment", "engender",
-        "ensheathe", "erosion", "eurhythmics", "expiry", "extirpator", "eyebrow",
-        "fourth", "fractiously", "gourmet", "graben", "grips", "hardships",
-        "headachy", "heterochromosome", "hydride", "immemorially", "injuriousness",
-        "insectivore", "laconically", "latte", "libidinal", "limitable",
-        "logicians", "longshoremen", "lounges", "masterships", "nonjuror",
-        "nystatins", "obstructionism", "onerousness", "outproduce", "overprotect",
-        "parsimoniousnesses", "physiognomic", "pikestaff", "pituri", "pouncer",
-        "prebendary", "pressies", "proficient", "psychotropic", "pudgy",
-        "pyrexias", "questioned", "reefers", "residues", "reticently", "rotunda",
-        "shikari", "signalisation", "speechmakers", "spelled", "starflower",
-        "steamily", "sucks", "surplusages", "tinge", "transects", "uncaught",
-        "underscoring", "unsuspecting", "versify", "voting", "weasels",
-        "whichever", "wordiest",
-    ]
 
+# just a selection of 99 random words, if there's no dictionary
+FALLBACK_WORDLIST = [
+    "abstractions", "allspice", "anisometropias", "associative", "banderilla",
+    "brainteasers", "breaststrokes", "broadbills", "brooders", "cageling",
+    "captives", "carven", "cellulosic", "chapels", "cheerless", "chemosmosis",
+    "classmates", "clock", "corollary", "corrupting", "cucurbits", "culpably",
+    "deciles", "declaratory", "deerhounds", "digression", "diminishes",
+    "ectomere", "educe", "elegance", "eloign", "encompassment", "engender",
+    "ensheathe", "erosion", "eurhythmics", "expiry", "extirpator", "eyebrow",
+    "fourth", "fractiously", "gourmet", "graben", "grips", "hardships",
+    "headachy", "heterochromosome", "hydride", "immemorially", "injuriousness",
+    "insectivore", "laconically", "latte", "libidinal", "limitable",
+    "logicians", "longshoremen", "lounges", "masterships", "nonjuror",
+    "nystatins", "obstructionism", "onerousness", "outproduce", "overprotect",
+    "parsimoniousnesses", "physiognomic", "pikestaff", "pituri", "pouncer",
+    "prebendary", "pressies", "proficient", "psychotropic", "pudgy",
+    "pyrexias", "questioned", "reefers", "residues", "reticently", "rotunda",
+    "shikari", "signalisation", "speechmakers", "spelled", "starflower",
+    "steamily", "sucks", "surplusages", "tinge", "transects", "uncaught",
+    "underscoring", "unsuspecting", "versify", "voting", "weasels",
+    "whichever", "wordiest",
+]
+
+
+def load_wordlist():
+    """ Words for passphrases; only the server needs them, so this is
+        not done at import time.
+    """
+    # need debian package wbritish-large
+    try:
+        with open("/usr/share/dict/british-english-large") as words:
+            return [
+                word
+                for word in (line.rstrip() for line in words)
+                if word and word[0].islower() and "'" not in word and word.isascii()
+            ]
+    except FileNotFoundError:
+        return FALLBACK_WORDLIST
 
-class PaintNet(ThreadingMixIn, HTTPServer):
+
+class PaintNet:
     """ Paint Server. Manages image paint events and distributes updates
         to different clients.
+        Runs as an aiohttp app on a single event loop: long-polling
+        clients wait on an asyncio.Condition instead of each occupying a
+        thread. A client is identified by its connection (host, port).
     """
     def __init__(self, *, server, port):
-        super().__init__((server, port), PaintRequestHandler)
         self.server = server
         self.port = port
         self.painting = []
+        # all paint events as JSON, each one prefixed by a comma, and the
+        # offset of each event's comma in there
+        self._joined = bytearray()
+        self._offsets = []
+        self._generation = 0  # bumped by new()
+        self._snapshot = None  # (generation, len(painting), png)
         self.client_states = {}
-        self.passphrase = "-".join(random.choices(WORDLIST, k=3))
+        self._cv = None  # asyncio.Condition, notified on every change; see _startup()
+        self.passphrase = "-".join(random.choices(load_wordlist(), k=3))
+        self.passphrase_bytes = self.passphrase.encode()
+        # handlers only enqueue their log lines, this thread logs them
+        self.log_queue = queue.SimpleQueue()
+        threading.Thread(target=self._log_requests, name="paint-log", daemon=True).start()
+        self.app = web.Application(middlewares=[self.dispatch])
+        self.app.on_startup.append(self._startup)
+        self.app.router.add_get("/status", self.handle_status)
+        self.app.router.add_get("/new", self.handle_new)
+        self.app.router.add_get("/draw", self.handle_draw)
+        self.app.router.add_post("/draw_batch", self.handle_draw_batch)
+        self.app.router.add_post("/d", self.handle_d)
+        self.app.router.add_get("/snapshot", self.handle_snapshot)
+        self.app.router.add_get("/updates", self.handle_updates)
+        self.app.router.add_route("*", "/{path:.*}", self.handle_unknown)
+
+    async def _startup(self, _app):
+        self._cv = asyncio.Condition()
+
+    def _log_requests(self):
+        while True:
+            level, message = self.log_queue.get()
+            logger.log(level, message)
 
-    def status(self):
+    # request handling
+
+    @web.middleware
+    async def dispatch(self, request, handler):
+        """ Checks the passphrase cookie and logs every request.
+        """
+        response = self.authorize(request) or await handler(request)
+        client = client_of(request)
+        self.log_queue.put_nowait(
+            ("INFO", f"{client[0]}:{client[1]} \"{request.method} {request.path_qs}\" {response.status} {response.content_length}"),
+        )
+        return response
+
+    def authorize(self, request):
+        """ None if the passphrase cookie is ok, else a 401 response.
+        """
+        _, found, passphrase = request.headers.get("Cookie", "").partition("passphrase=")
+        if not found:
+            return respond(401, orjson.dumps({"error": "bad cookie, what is wrong with you!"}))
+        passphrase = passphrase.split(";", 1)[0]
+        # constant time compare, don't leak how much of the passphrase is right
+        if not hmac.compare_digest(passphrase.encode(), self.passphrase_bytes):
+            logger.error(f"wrong passphrase in cookies: {passphrase}")
+            return respond(401, orjson.dumps({"error": "not authorized"}))
+        return None
+
+    async def handle_status(self, request):
+        query = parse_query(request.query_string)
+        return respond(200, self.status(pretty="pretty" in query))
+
+    async def handle_new(self, request):
+        return respond(200, await self.new(client=client_of(request)))
+
+    async def handle_draw(self, request):
+        query = parse_query(request.query_string)
+        try:
+            response = await self.draw(
+                color=query["color"],
+                width=query["width"],
+                start_point=query["start_point"],
+                end_point=query["end_point"],
+                client=client_of(request),
+            )
+        except (ValueError, KeyError, TypeError) as err:
+            return bad_request(request, err)
+        return respond(200, response)
+
+    async def handle_draw_batch(self, request):
+        body = await request.read()
+        try:
+            response = await self.draw_batch(
+                orjson.loads(body),
+                client=client_of(request),
+            )
+        except (ValueError, KeyError, TypeError) as err:  # JSONDecodeError is a ValueError
+            return bad_request(request, err)
+        return respond(200, response)
+
+    async def handle_d(self, request):
+        body = await request.read()
+        try:
+            paint_codes = unpack_paintcodes(body)
+        except (struct.error, IndexError):
+            logger.warning(f"invalid binary paint events ({len(body)} bytes)")
+            return respond(400, orjson.dumps({"error": "invalid paint events"}))
+        return respond(200, await self.draw_batch(paint_codes, client=client_of(request)))
+
+    async def handle_snapshot(self, request):
+        png = await self.snapshot(client=client_of(request))
+        if png is None:
+            return respond(500, orjson.dumps({"error": "rendering snapshot failed"}))
+        return respond(200, png, content_type="image/png")
+
+    async def handle_updates(self, request):
+        query = parse_query(request.query_string)
+        try:
+            wait = float(query["wait"]) if "wait" in query else 0
+        except ValueError as err:
+            return bad_request(request, err)
+        return respond(
+            200,
+            await self.get_updates(
+                client=client_of(request),
+                from_beginning="from_beginning" in query,
+                wait=wait,
+                max_lag=MAX_LAG,
+            ),
+        )
+
+    async def handle_unknown(self, request):
+        logger.warning(f"invalid request: {request.method} {request.path_qs}")
+        return respond(400, f"unknown path: {request.path}")
+
+    # painting state; all of this runs on the event loop, so no locking
+
+    def status(self, pretty=False):
         len_painting = len(self.painting)
-        return json.dumps({
+        status = {
             "clients": [
                 {
                     "client": c,
@@ -450,39 +890,122 @@ class PaintNet(ThreadingMixIn, HTTPServer):
                 for c, s in self.client_states.items()
             ],
             "len-painting": len_painting,
-        }, sort_keys=True, indent=4)
+        }
+        if pretty:
+            return orjson.dumps(status, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        return orjson.dumps(status)
 
-    def new(self, client):
+    async def new(self, client):
         logger.info(f"new canvas (client: {client})")
         self.painting = []
+        self._joined = bytearray()
+        self._offsets = []
+        self._generation += 1
+        self._snapshot = None
         self.client_states = {
             client: 0 for client in self.client_states.keys()
         }
         self.client_states[client] = 0
-        return json.dumps(self.painting)
+        await self._notify()
+        return "[]"
 
-    def draw(self, client, *, color, width, start_point, end_point):
-        logger.debug(f"draw {start_point} -> {end_point} (client: {client})")
-        self.painting.append({
+    async def draw(self, client, *, color, width, start_point, end_point):
+        logger.debug("draw {} -> {} (client: {})", start_point, end_point, client)
+        await self._append([check_paint_code({
             "color": color,
-            "width": int(width),
+            "width": width,
             "start_point": start_point,
             "end_point": end_point,
-        })
-        return self.get_updates(client, from_beginning=False)
+        })])
+        return await self.get_updates(client, from_beginning=False)
 
-    def get_updates(self, client, from_beginning):
-        len_painting = len(self.painting)
+    async def draw_batch(self, paint_codes, client):
+        logger.debug("draw batch of {} events (client: {})", len(paint_codes), client)
+        # check all of them first, so a bad batch stores nothing
+        events = [check_paint_code(pc) for pc in paint_codes]
+        await self._append(events)
+        # just an ack: the sender is usually not the polling connection,
+        # so don't move its update state (or send it any updates)
+        return orjson.dumps({"received": len(events)})
+
+    async def _append(self, events):
+        """ Add paint events; each one is JSON encoded exactly once, here.
+        """
+        self.painting.extend(events)
+        for event in events:
+            self._offsets.append(len(self._joined))
+            self._joined += b","
+            self._joined += orjson.dumps(event)
+        await self._notify()
+
+    async def _notify(self):
+        async with self._cv:
+            self._cv.notify_all()
+
+    async def get_updates(self, client, from_beginning, wait=0, max_lag=None):
+        """ Paint events `client` hasn't seen yet. With `wait` > 0 this is a
+            long-poll: if there is nothing new, wait up to `wait` seconds
+            (at most LONG_POLL_MAX) until some other client draws.
+            With `max_lag` (only for /updates polls), clients lagging more
+            than that many events behind just get {"reset": true}; a
+            /snapshot is cheaper for them than replaying.
+        """
         if from_beginning:
             self.client_states.pop(client, None)
         start = self.client_states.get(client, 0)
-        self.client_states[client] = len_painting
-        return json.dumps(self.painting[start:])
+        if wait > 0 and start == len(self.painting):
+            async with self._cv:
+                try:
+                    await asyncio.wait_for(self._cv.wait(), timeout=min(wait, LONG_POLL_MAX))
+                except asyncio.TimeoutError:
+                    pass
+            start = self.client_states.get(client, 0)  # /new resets it
+        lag = len(self.painting) - start
+        self.client_states[client] = len(self.painting)
+        if max_lag is not None and lag > max_lag and not from_beginning:
+            logger.warning("client {} lagging {} events, forcing snapshot", client, lag)
+            return b'{"reset":true}'
+        if start >= len(self._offsets):
+            return b"[]"
+        # skip the leading comma of the first event
+        with memoryview(self._joined) as joined:
+            return b"".join((b"[", joined[self._offsets[start] + 1:], b"]"))
+
+    async def snapshot(self, client):
+        """ The painting so far as PNG; `client` gets incremental updates
+            from there on. The PNG is cached until the painting changes.
+            None if rendering fails.
+        """
+        while True:
+            generation = self._generation
+            version = len(self.painting)
+            if self._snapshot and self._snapshot[:2] == (generation, version):
+                self.client_states[client] = version
+                return self._snapshot[2]
+            # render in a thread, other clients keep drawing meanwhile
+            try:
+                png = await asyncio.get_running_loop().run_in_executor(
+                    None, render_png, self.painting[:version],
+                )
+            except Exception as err:  # pylint: disable=broad-except
+                logger.error(f"rendering snapshot failed: {err!r}")
+                return None
+            if generation == self._generation:  # else: /new meanwhile, again
+                self._snapshot = (generation, version, png)
+                self.client_states[client] = version
+                return png
 
     def exec_(self):
         logger.warning(f"passphrase: {self.passphrase}")
         logger.info("serving forever...")
-        self.serve_forever()
+        web.run_app(
+            self.app,
+            host=self.server,
+            port=self.port,
+            access_log=None,  # we log requests ourselves, see dispatch()
+            keepalive_timeout=KEEP_ALIVE_TIMEOUT,
+            print=None,
+        )
         return 0
 
 
@@ -516,7 +1039,7 @@ def server_command(port):
 @click.option("--port", type=int, default=8088, help="dispaint server (port)")
 @click.option("--passphrase", required=True, help="server passphrase")
 @click.option("--color", type=click.Choice(COLOR_NAMES), default="black")
-@click.option("--interval", type=int, default=50, help="poll interval in ms")
+@click.option("--interval", type=int, default=50, help="min. ms between polls")
 def paint_command(server, port, passphrase, interval, color):
     """ Let's paint some stuff.
     """